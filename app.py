@@ -1,11 +1,21 @@
-import streamlit as st
+import csv
+import functools
+import io
+import re
+
+import jinja2
+import numpy as np
 import pandas as pd
+import streamlit as st
 
 # --- PAGE CONFIGURATION ---
 st.set_page_config(page_title="November Survey Analysis", layout="wide", page_icon="🏫")
 
 # --- CSS STYLING ---
-st.markdown("""
+@st.cache_resource
+def page_css():
+    # Static style block, built once per process instead of per rerun
+    return """
 <style>
     /* Card Styling */
     .card-header { 
@@ -27,6 +37,8 @@ st.markdown("""
     .bar-subject { background: #2980b9; z-index: 2; }
 
     /* Question Drill Down Charts */
+    details summary { cursor: pointer; font-size: 0.85em; color: #555; padding: 5px 0; list-style: none; }
+    details summary::-webkit-details-marker { display: none; }
     .q-row { display: flex; align-items: center; margin-bottom: 8px; padding-bottom: 8px; border-bottom: 1px solid #f0f0f0; }
     .q-text { flex: 1; font-size: 0.85em; color: #555; padding-right: 15px; }
     .q-viz { flex: 1; max-width: 50%; }
@@ -40,7 +52,9 @@ st.markdown("""
     .diff-green { background: #27ae60; }
     .diff-red { background: #c0392b; }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+st.html(page_css())
 
 # --- FACULTY DEFINITIONS ---
 FACULTY_DEFS = {
@@ -61,114 +75,380 @@ CATEGORIES = {
     "4. Support & Feedback": ["6 ", "7 ", "10 ", "12 "]
 }
 
+POSITIVE_RESPONSES = {'agree', 'strongly agree'}
+
+# str.startswith takes a tuple directly - one C call per column
+PREFIX_TUPLES = {cat: tuple(prefixes) for cat, prefixes in CATEGORIES.items()}
+ALL_PREFIXES = tuple(p for prefixes in CATEGORIES.values() for p in prefixes)
+
+# One alternation regex per faculty, compiled once at import
+FACULTY_PATTERNS = {
+    fac: re.compile('|'.join(re.escape(k.lower()) for k in keywords))
+    for fac, keywords in FACULTY_DEFS.items()
+}
+
+# Keywords the mapping selectboxes search for (keep in sync with the
+# find_column calls in the sidebar)
+YEAR_KEYWORDS = ['year group', 'group', 'stage']
+SUBJ_KEYWORDS = ['which subject', 'subject answering', 'subject today']
+
+# --- HTML TEMPLATES (compiled once at import) ---
+# The whole report renders through ONE st.markdown call: the per-category
+# drill-down is a native <details> block instead of a Streamlit expander,
+# which cuts the per-render element round-trips from ~8 to 1.
+_JINJA_ENV = jinja2.Environment(autoescape=False)
+
+REPORT_TEMPLATE = _JINJA_ENV.from_string("""
+{%- for c in cards %}
+<div class="card-header">
+    <h3>{{ c.cat }} {{ c.badge }}</h3>
+    <div class="bar-container">
+        <div class="label"><span>Category Score</span><span>{{ c.s_score|int }}%</span></div>
+        <div class="track">
+            <div class="bar bar-school" style="width: {{ c.b_score }}%"></div>
+            <div class="bar bar-subject" style="width: {{ c.s_score }}%; background: {{ c.color }};"></div>
+        </div>
+    </div>
+    <details>
+        <summary>▼ Breakdown by Question</summary>
+        {%- for q in c.questions %}
+        <div class="q-row">
+            <div class="q-text">{{ q.text }}</div>
+            <div class="q-viz">
+                <div class="q-track">
+                    <div class="q-bar-school" style="width:{{ q.qb }}%"></div>
+                    <div class="q-bar-subject" style="width:{{ q.qs }}%"></div>
+                </div>
+                <div class="q-stats">You: {{ q.qs|int }}% | Bench: {{ q.qb|int }}%</div>
+            </div>
+        </div>
+        {%- endfor %}
+    </details>
+</div>
+{%- endfor %}
+""")
+
 # --- HELPER FUNCTIONS ---
-@st.cache_data
-def load_data(file):
-    # List of encodings to try: 
-    # 1. utf-8-sig (Best for Excel on Windows)
-    # 2. cp1252 (Standard Windows encoding)
-    # 3. latin1 (Old fallback)
-    encodings = ['utf-8-sig', 'cp1252', 'latin1']
-    
+# Bounded caches: keep the last few uploads for 2h, then evict,
+# so stale CSVs don't pile up in memory for the life of the process
+@st.cache_data(max_entries=4, ttl=7200, show_spinner="Parsing CSV…")
+def load_data(file_bytes):
+    # Takes the raw bytes so the cache is keyed on file CONTENT,
+    # not on whichever UploadedFile object Streamlit hands us this rerun.
+    # Sniff the encoding from the first 4 KB instead of parsing the whole
+    # file once per candidate encoding:
+    # - A BOM tells us directly (Excel writes one for 'CSV UTF-8')
+    # - Otherwise, if the sample decodes as UTF-8, use that
+    # - Broken UTF-8 bytes mean a legacy Windows export (cp1252, latin1 fallback)
+    head = file_bytes[:4096]
+    if head.startswith(b'\xef\xbb\xbf'):
+        encodings = ['utf-8-sig']
+    elif head.startswith((b'\xff\xfe', b'\xfe\xff')):
+        encodings = ['utf-16']
+    else:
+        try:
+            head.decode('utf-8')
+            # Also fine for plain utf-8 / ascii. Keep the Windows encodings as
+            # trailing fallbacks: an ASCII-only head doesn't prove the REST of
+            # the file is UTF-8 (e.g. a cp1252 export whose first accented
+            # character appears after the 4 KB mark)
+            encodings = ['utf-8-sig', 'cp1252', 'latin1']
+        except UnicodeDecodeError as e:
+            if e.start >= len(head) - 4:
+                # Just a multi-byte char cut off at the 4 KB boundary
+                encodings = ['utf-8-sig', 'cp1252', 'latin1']
+            else:
+                encodings = ['cp1252', 'latin1']
+
     for enc in encodings:
         try:
-            # RESET the file pointer to the start (Critical step for Streamlit)
-            file.seek(0)
-            
-            # Try reading with the current encoding
-            df = pd.read_csv(file, encoding=enc, sep=None, engine='python')
-            
+            # Sniff the delimiter from the sample so the fast C parser can be
+            # used even for semicolon/tab exports; the (10x slower) sniffing
+            # Python engine is only the last resort. The header-only read
+            # settles the engine cheaply before we parse any data rows.
+            try:
+                sample = head.decode(enc, errors='replace')
+                sep = csv.Sniffer().sniff(sample, delimiters=',;\t|').delimiter
+                read_kwargs = {'encoding': enc, 'sep': sep}
+                hdr = pd.read_csv(io.BytesIO(file_bytes), nrows=0, **read_kwargs)
+                if hdr.shape[1] <= 1:
+                    raise csv.Error("single column - bad delimiter guess")
+            except (csv.Error, pd.errors.ParserError):
+                read_kwargs = {'encoding': enc, 'sep': None, 'engine': 'python'}
+                hdr = pd.read_csv(io.BytesIO(file_bytes), nrows=0, **read_kwargs)
+
+            # Only parse the columns the app can actually use: question columns,
+            # mapping-keyword candidates, plus the first two (the mapping
+            # fallback defaults). Free-text comment columns never get read.
+            needed = []
+            for raw in hdr.columns:
+                name = str(raw).strip().replace('﻿', '')
+                lc = name.lower()
+                if (name.startswith(ALL_PREFIXES)
+                        or any(k in lc for k in YEAR_KEYWORDS + SUBJ_KEYWORDS)
+                        or raw in list(hdr.columns[:2])):
+                    needed.append(raw)
+
+            df = pd.read_csv(io.BytesIO(file_bytes), usecols=needed, **read_kwargs)
+
             # If we get here, it worked! Clean the columns
             df.columns = [str(c).strip().replace('\ufeff', '') for c in df.columns]
-            
+
             # Remove empty garbage rows/cols
             df = df.dropna(how='all', axis=0).dropna(how='all', axis=1)
+            df = df.reset_index(drop=True)  # Positional index so masks line up with the matrices
+            df.attrs['lower_cols'] = [c.lower() for c in df.columns]  # For find_column
             return df
-            
+
         except Exception:
             # If it fails, just continue to the next encoding in the list
             continue
-            
+
     # If we tried all encodings and still failed:
     st.error("Could not read file. Please save it as 'CSV UTF-8' in Excel.")
     return None
-def find_column(df, keywords):
-    for col in df.columns:
-        if any(k in col.lower() for k in keywords):
+@functools.lru_cache(maxsize=32)
+def _find_column(columns, lower_cols, keywords):
+    for col, lc in zip(columns, lower_cols):
+        if any(k in lc for k in keywords):
             return col
     return None
 
-def assign_faculty(subj):
-    s_clean = str(subj).lower()
-    for fac, keywords in FACULTY_DEFS.items():
-        if any(k.lower() in s_clean for k in keywords):
-            return fac
-    return "Other"
+def find_column(df, keywords):
+    # Lowercased names come precomputed from load_data - no re-lowering per call.
+    # The scan itself is memoized: it runs twice per rerun with identical inputs.
+    lower_cols = df.attrs.get('lower_cols') or [str(c).lower() for c in df.columns]
+    return _find_column(tuple(df.columns), tuple(lower_cols), tuple(keywords))
+
+def assign_stages(year_series):
+    # Vectorized replacement for the old per-row get_stage()
+    y = year_series.astype(str).str.upper()
+    return np.select(
+        [y.str.contains('S1|S2'), y.str.contains('S3'), y.str.contains('S4|S5|S6')],
+        ['S1 & S2', 'S3', 'Senior Phase'],
+        default='Other'
+    )
+
+def assign_faculties(subj_series):
+    # One precompiled regex per faculty, matched in C by pandas instead of a
+    # Python loop per row. np.select keeps the same first-match-wins priority
+    # as the old dict loop.
+    s = subj_series.astype(str).str.lower()
+    masks = [s.str.contains(pat, regex=True) for pat in FACULTY_PATTERNS.values()]
+    return np.select(masks, list(FACULTY_PATTERNS.keys()), default='Other')
+
+@st.cache_data(max_entries=4, ttl=7200, show_spinner="Preparing data…")
+def prepare_data(file_bytes, year_col, subj_col):
+    # Everything deterministic from (file, column mapping) is derived here once.
+    # Widget interactions below only filter rows and sum booleans.
+    df = load_data(file_bytes)
+    if df is None: return None
+    df = df.copy()
+
+    # Apply Mapping
+    df['Mapped_Year'] = df[year_col]
+    df['Mapped_Subj'] = df[subj_col].astype(str).str.strip()
+
+    # Define Stages / Faculties (vectorized - no Python call per row)
+    df['Stage'] = assign_stages(df['Mapped_Year'])
+    df['Faculty'] = assign_faculties(df['Mapped_Subj'])
+
+    # Categorical dtype so the filter masks below compare integer codes,
+    # not Python strings row by row
+    for c in ['Mapped_Subj', 'Stage', 'Faculty']:
+        df[c] = df[c].astype('category')
+
+    # Encode every answer ONCE as int8: 1 = positive, 0 = other answer, -1 = missing.
+    # One byte per cell instead of a ~50 B string object, and no string ops after this
+    qcols = [c for c in df.columns if c.startswith(ALL_PREFIXES)]
+    codes = np.empty((len(df), len(qcols)), dtype=np.int8)
+    for i, c in enumerate(qcols):
+        norm = df[c].astype('string').str.strip().str.lower()
+        col = norm.isin(POSITIVE_RESPONSES).to_numpy(dtype=np.int8)
+        col[norm.isna().to_numpy()] = -1
+        codes[:, i] = col
+    pos_mat = codes == 1
+    valid_mat = codes != -1
 
-def calc_pos_rate(series):
-    valid = series.dropna().astype(str).str.lower().str.strip()
-    if valid.empty: return 0.0
-    return (valid.isin(['agree', 'strongly agree']).sum() / len(valid)) * 100
+    # Category -> question columns (and matrix indices), resolved once per upload
+    # instead of rescanning df.columns on every rerun
+    qcol_idx = {c: i for i, c in enumerate(qcols)}
+    col_map = {cat: [c for c in qcols if c.startswith(PREFIX_TUPLES[cat])] for cat in CATEGORIES}
+    cat_idx_map = {cat: np.array([qcol_idx[c] for c in cols], dtype=np.intp) for cat, cols in col_map.items()}
+    qtext = {c: c.strip('"') for c in qcols}  # Display label per question
+
+    # Contiguous layout of the (non-empty) categories' column indices, so ALL
+    # category aggregates come out of a single np.add.reduceat per count vector
+    cats_order = [cat for cat in CATEGORIES if col_map[cat]]
+    ordered_idx = (np.concatenate([cat_idx_map[cat] for cat in cats_order])
+                   if cats_order else np.array([], dtype=np.intp))
+    cat_offsets = np.cumsum([0] + [len(cat_idx_map[cat]) for cat in cats_order])[:-1]
+    cat_slot = {cat: i for i, cat in enumerate(cats_order)}
+
+    # Sidebar lists, sorted once per upload ("Other" always goes last)
+    # dropna: blank subject cells survive astype(str) as NaN and would blow up the sort
+    subjects_by_faculty = {fac: sorted(subs.dropna().unique()) for fac, subs in df.groupby('Faculty')['Mapped_Subj']}
+    fac_list = sorted(f for f in subjects_by_faculty if f != "Other")
+    if "Other" in subjects_by_faculty: fac_list.append("Other")
+
+    # The matrices and maps above carry all the answers now - cache only the
+    # filter columns, not the raw response strings (~50 B per cell)
+    df = df[['Mapped_Year', 'Mapped_Subj', 'Stage', 'Faculty']]
+
+    return {'df': df, 'qcols': qcols, 'pos_mat': pos_mat, 'valid_mat': valid_mat,
+            'qcol_idx': qcol_idx, 'col_map': col_map, 'cat_idx_map': cat_idx_map,
+            'qtext': qtext, 'fac_list': fac_list, 'subjects_by_faculty': subjects_by_faculty,
+            'ordered_idx': ordered_idx, 'cat_offsets': cat_offsets, 'cat_slot': cat_slot}
+
+def calc_pos_rate(pos_count, valid_count):
+    # The counts are already aggregated - this is just a safe percentage
+    if valid_count == 0: return 0.0
+    return (pos_count / valid_count) * 100
+
+@st.cache_data(max_entries=32, ttl=7200)
+def build_report(file_bytes, year_col, subj_col, sel_fac, sel_stage, sel_bench, sel_subjects):
+    # Memoized per (file, mapping, selection): users flip between the same few
+    # selections, and repeats re-serve the finished HTML without recomputing.
+    # sel_subjects arrives as a sorted tuple so the cache key is stable.
+    data = prepare_data(file_bytes, year_col, subj_col)
+    df = data['df']
+    pos_mat, valid_mat = data['pos_mat'], data['valid_mat']
+    qcol_idx, col_map, qtext = data['qcol_idx'], data['col_map'], data['qtext']
+    ordered_idx, cat_offsets, cat_slot = data['ordered_idx'], data['cat_offsets'], data['cat_slot']
+
+    # Boolean row masks into the cached matrices - no DataFrame copies
+    # 1. Active rows (Stage Filter)
+    stage_mask = np.ones(len(df), dtype=bool) if sel_stage == 'All Years' else (df['Stage'].values == sel_stage)
+    subj_mask = df['Mapped_Subj'].isin(sel_subjects).values
+
+    # 2. Target rows (User Selection)
+    target_mask = stage_mask & subj_mask
+
+    # 3. Benchmark rows
+    if sel_bench == "Whole School Average":
+        bench_mask = stage_mask # Everyone in that stage
+        bench_label = "Whole School"
+    elif sel_bench == "Faculty Average":
+        # Everyone in the Faculty (regardless of user subject selection)
+        bench_mask = stage_mask & (df['Faculty'].values == sel_fac)
+        bench_label = f"{sel_fac}"
+    else: # Department Average
+        # Everyone in the SELECTED subjects (e.g. just French)
+        # Note: If looking at S3 French, this compares to S3 French (Self-comparison)
+        # Unless we want Dept Average to always be ALL YEARS?
+        # Let's make Dept Average = The chosen subjects across ALL YEARS (if possible)
+        # to show how this year compares to the department norm.
+        # actually, standard practice is usually comparing to the same cohort.
+        # Let's keep it simple: Department Average = The average of the selected subjects in this stage.
+        # If that's the same as target, it's 0 diff.
+        # BETTER: Department Average usually implies "The Subject Average"
+        bench_mask = subj_mask # All years for these subjects
+        bench_label = "Dept (All Years)"
+
+    if not target_mask.any():
+        return None
+
+    # One row-sum per group gives every per-question count in a single pass
+    t_pos, t_valid = pos_mat[target_mask].sum(axis=0), valid_mat[target_mask].sum(axis=0)
+
+    # Department Average with every subject selected (and All Years) picks the
+    # exact same rows as the target - reuse the target counts instead of
+    # reducing the matrices a second time (guaranteed 0-diff render)
+    if np.array_equal(bench_mask, target_mask):
+        b_pos, b_valid = t_pos, t_valid
+    else:
+        b_pos, b_valid = pos_mat[bench_mask].sum(axis=0), valid_mat[bench_mask].sum(axis=0)
+
+    # ...and one reduceat per count vector gives every category total
+    cat_t_pos = np.add.reduceat(t_pos[ordered_idx], cat_offsets)
+    cat_t_valid = np.add.reduceat(t_valid[ordered_idx], cat_offsets)
+    if b_pos is t_pos:
+        cat_b_pos, cat_b_valid = cat_t_pos, cat_t_valid
+    else:
+        cat_b_pos = np.add.reduceat(b_pos[ordered_idx], cat_offsets)
+        cat_b_valid = np.add.reduceat(b_valid[ordered_idx], cat_offsets)
+
+    cards = []
+    for cat, cat_cols in col_map.items():
+        if not cat_cols: continue
+        slot = cat_slot[cat]
+
+        # Big Bar Maths
+        s_score = calc_pos_rate(cat_t_pos[slot], cat_t_valid[slot])
+        b_score = calc_pos_rate(cat_b_pos[slot], cat_b_valid[slot])
+        diff = s_score - b_score
+
+        color = "#2980b9"
+        badge = ""
+        if diff > 5: color, badge = "#27ae60", f"<span class='diff-badge diff-green'>+{int(diff)}%</span>"
+        elif diff < -5: color, badge = "#c0392b", f"<span class='diff-badge diff-red'>{int(diff)}%</span>"
+
+        questions = []
+        for q in cat_cols:
+            qi = qcol_idx[q]
+            questions.append({
+                'text': qtext[q],
+                'qs': calc_pos_rate(t_pos[qi], t_valid[qi]),
+                'qb': calc_pos_rate(b_pos[qi], b_valid[qi]),
+            })
+        cards.append({'cat': cat, 'badge': badge, 's_score': s_score,
+                      'b_score': b_score, 'color': color, 'questions': questions})
+
+    return {'html': REPORT_TEMPLATE.render(cards=cards), 'bench_label': bench_label,
+            'target_n': int(target_mask.sum()), 'bench_n': int(bench_mask.sum())}
 
 # --- MAIN APP ---
 st.title("🏫 November Survey Analysis")
 uploaded_file = st.sidebar.file_uploader("Upload Survey CSV", type="csv")
 
 if uploaded_file:
-    df = load_data(uploaded_file)
-    if df is not None:
-        
+    file_bytes = uploaded_file.getvalue()
+    raw_df = load_data(file_bytes)
+    if raw_df is not None:
+
         # --- 1. DATA MAPPING (Hidden by default) ---
         with st.sidebar.expander("🔧 Data Mapping (Advanced)"):
             st.caption("If columns aren't finding automatically, fix them here.")
-            
-            auto_year = find_column(df, ['year group', 'group', 'stage']) or df.columns[0]
-            auto_subj = find_column(df, ['which subject', 'subject answering', 'subject today']) or df.columns[1]
-            
-            year_col = st.selectbox("Year Group Column:", df.columns, index=list(df.columns).index(auto_year))
-            subj_col = st.selectbox("Subject Column:", df.columns, index=list(df.columns).index(auto_subj))
-
-        # Apply Mapping
-        df['Mapped_Year'] = df[year_col]
-        df['Mapped_Subj'] = df[subj_col].astype(str).str.strip()
-
-        # Define Stages
-        def get_stage(y):
-            y = str(y).upper()
-            if 'S1' in y or 'S2' in y: return 'S1 & S2'
-            if 'S3' in y: return 'S3'
-            return 'Senior Phase' if any(s in y for s in ['S4','S5','S6']) else 'Other'
-        
-        df['Stage'] = df['Mapped_Year'].apply(get_stage)
-        df['Faculty'] = df['Mapped_Subj'].apply(assign_faculty)
+
+            auto_year = find_column(raw_df, ['year group', 'group', 'stage']) or raw_df.columns[0]
+            auto_subj = find_column(raw_df, ['which subject', 'subject answering', 'subject today']) or raw_df.columns[1]
+
+            year_col = st.selectbox("Year Group Column:", raw_df.columns, index=list(raw_df.columns).index(auto_year))
+            subj_col = st.selectbox("Subject Column:", raw_df.columns, index=list(raw_df.columns).index(auto_subj))
+
+        # Cached per (file, mapping) - the sidebar only needs the group lists;
+        # all scoring happens inside the memoized build_report below
+        data = prepare_data(file_bytes, year_col, subj_col)
 
         # --- 2. FACULTY SELECTOR ---
         st.sidebar.divider()
         st.sidebar.header("1. Select Group")
         
-        fac_list = sorted([f for f in df['Faculty'].unique() if f != "Other"])
-        if "Other" in df['Faculty'].unique(): fac_list.append("Other")
-        
+        fac_list = data['fac_list']
+
         # Store selection in session state to handle resets
         if 'selected_faculty' not in st.session_state: st.session_state.selected_faculty = fac_list[0]
         
         sel_fac = st.sidebar.selectbox("Choose Faculty", fac_list, key='fac_select')
         
-        # Get subjects in this faculty
-        fac_subjects = sorted(df[df['Faculty'] == sel_fac]['Mapped_Subj'].unique())
+        # Get subjects in this faculty (precomputed in prepare_data)
+        fac_subjects = data['subjects_by_faculty'][sel_fac]
         
         # --- 3. SUBJECT FILTER (With Reset) ---
         st.sidebar.header("2. Analysis Focus")
         
-        # Reset Button Logic
+        # Reset Button Logic: bump the key version so the multiselect below
+        # remounts fresh with its defaults on THIS rerun, instead of writing
+        # session state after instantiation and paying a second full pass
+        ver = st.session_state.setdefault('subj_ver', 0)
         if st.sidebar.button("🔄 Reset to Whole Faculty"):
-            st.session_state[f"subj_{sel_fac}"] = fac_subjects
-            
+            ver = st.session_state['subj_ver'] = ver + 1
+
         sel_subjects = st.sidebar.multiselect(
-            "Select Subjects:", 
-            fac_subjects, 
+            "Select Subjects:",
+            fac_subjects,
             default=fac_subjects,
-            key=f"subj_{sel_fac}" # Unique key per faculty preserves state
+            key=f"subj_{sel_fac}_{ver}" # Unique key per faculty preserves state
         )
         
         if not sel_subjects:
@@ -182,95 +462,23 @@ if uploaded_file:
         bench_opts = ["Whole School Average", "Faculty Average", "Department Average"]
         sel_bench = st.sidebar.selectbox("Compare Against:", bench_opts)
 
-        # --- DATA PROCESSING ---
-        # 1. Active Data (Stage Filter)
-        active_df = df if sel_stage == 'All Years' else df[df['Stage'] == sel_stage]
-        
-        # 2. Target Data (User Selection)
-        target_df = active_df[active_df['Mapped_Subj'].isin(sel_subjects)]
-        
-        # 3. Benchmark Data
-        if sel_bench == "Whole School Average":
-            bench_df = active_df # Everyone in that stage
-            bench_label = "Whole School"
-        elif sel_bench == "Faculty Average":
-            # Everyone in the Faculty (regardless of user subject selection)
-            bench_df = active_df[active_df['Faculty'] == sel_fac]
-            bench_label = f"{sel_fac}"
-        else: # Department Average
-            # Everyone in the SELECTED subjects (e.g. just French)
-            # Note: If looking at S3 French, this compares to S3 French (Self-comparison)
-            # Unless we want Dept Average to always be ALL YEARS? 
-            # Let's make Dept Average = The chosen subjects across ALL YEARS (if possible) 
-            # to show how this year compares to the department norm.
-            # actually, standard practice is usually comparing to the same cohort.
-            # Let's keep it simple: Department Average = The average of the selected subjects in this stage.
-            # If that's the same as target, it's 0 diff. 
-            # BETTER: Department Average usually implies "The Subject Average"
-            bench_df = df[df['Mapped_Subj'].isin(sel_subjects)] # All years for these subjects
-            bench_label = "Dept (All Years)"
-
-        if target_df.empty:
+        # --- DATA PROCESSING + DASHBOARD ---
+        # Memoized: repeat selections re-serve the finished HTML
+        report = build_report(file_bytes, year_col, subj_col,
+                              sel_fac, sel_stage, sel_bench, tuple(sorted(sel_subjects)))
+
+        if report is None:
             st.warning("No data found for this selection.")
         else:
-            # --- DASHBOARD ---
             c1, c2, c3 = st.columns(3)
             c1.metric("Target", f"{len(sel_subjects)} Subjects" if len(sel_subjects) > 1 else sel_subjects[0])
             c2.metric("Stage", sel_stage)
-            c3.metric("Responses", len(target_df))
-            st.caption(f"Comparing against: **{bench_label}** ({len(bench_df)} responses)")
+            c3.metric("Responses", report['target_n'])
+            st.caption(f"Comparing against: **{report['bench_label']}** ({report['bench_n']} responses)")
             st.divider()
 
-            for cat, prefixes in CATEGORIES.items():
-                cat_cols = [c for c in df.columns if any(c.startswith(p) for p in prefixes)]
-                if not cat_cols: continue
-                
-                # Big Bar Maths
-                s_score = calc_pos_rate(pd.Series(target_df[cat_cols].values.flatten()))
-                b_score = calc_pos_rate(pd.Series(bench_df[cat_cols].values.flatten()))
-                diff = s_score - b_score
-                
-                color = "#2980b9"
-                badge = ""
-                if diff > 5: color, badge = "#27ae60", f"<span class='diff-badge diff-green'>+{int(diff)}%</span>"
-                elif diff < -5: color, badge = "#c0392b", f"<span class='diff-badge diff-red'>{int(diff)}%</span>"
-
-                # 1. RENDER MAIN CARD (HTML)
-                st.markdown(f"""
-                <div class="card-header">
-                    <h3>{cat} {badge}</h3>
-                    <div class="bar-container">
-                        <div class="label"><span>Category Score</span><span>{int(s_score)}%</span></div>
-                        <div class="track">
-                            <div class="bar bar-school" style="width: {b_score}%"></div>
-                            <div class="bar bar-subject" style="width: {s_score}%; background: {color};"></div>
-                        </div>
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
-                
-                # 2. RENDER DRILL DOWN (Native Expander)
-                # We separate this from the HTML block above to fix the rendering issue
-                with st.expander(f"▼ Breakdown by Question ({cat})"):
-                    q_html = ""
-                    for q in cat_cols:
-                        qs = calc_pos_rate(target_df[q])
-                        qb = calc_pos_rate(bench_df[q])
-                        q_text = q.strip('"')
-                        
-                        q_html += f"""
-                        <div class="q-row">
-                            <div class="q-text">{q_text}</div>
-                            <div class="q-viz">
-                                <div class="q-track">
-                                    <div class="q-bar-school" style="width:{qb}%"></div>
-                                    <div class="q-bar-subject" style="width:{qs}%"></div>
-                                </div>
-                                <div class="q-stats">You: {int(qs)}% | Bench: {int(qb)}%</div>
-                            </div>
-                        </div>
-                        """
-                    st.markdown(q_html, unsafe_allow_html=True)
+            # ONE markdown call for the entire report
+            st.markdown(report['html'], unsafe_allow_html=True)
 
 else:
     st.info("Please upload your survey CSV to begin.")